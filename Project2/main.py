@@ -11,6 +11,7 @@ async def main():
         output_folder="products_json",
         batch_size=1000,
         concurrent_requests=50,
+        requests_per_second=50,
         max_retries=5
     )
     
@@ -1,5 +1,5 @@
 from collections import defaultdict
-from datetime import datetime
+import time
 
 
 class CrawlStats:
@@ -29,7 +29,7 @@ class CrawlStats:
                 "product_id": product_id,
                 "error_code": status_code or "UNKNOWN",
                 "error_message": error_message or "",
-                "timestamp": datetime.now().isoformat()
+                "timestamp": time.time()  # Formatted as ISO when failures are saved
             })
             
     def add_missing_fields(self):
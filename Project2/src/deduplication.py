@@ -1,32 +1,56 @@
 import os
-import json
+import orjson
+
+from src.file_handler import iter_ndjson, list_batch_files, map_batch_files
+
+
+def _read_batch_ids(filepath):
+    """Read one batch file and return the product IDs it contains"""
+    try:
+        with open(filepath, 'rb') as f:
+            data = orjson.loads(f.read())
+        return [product.get('id') for product in data]
+    except Exception as e:
+        print(f"Error reading {os.path.basename(filepath)}: {e}")
+        return []
 
 
 class DeduplicationUtils:
     """Utilities for handling duplicate detection and removal"""
     
-    @staticmethod
-    def deduplicate_list(items):
-        """Remove duplicates from list while preserving order"""
-        return list(dict.fromkeys(items))
-    
     @staticmethod
     def get_already_crawled_ids(output_folder):
-        """Get set of product IDs that were already successfully crawled"""
+        """Get set of integer product IDs that were already successfully crawled"""
         crawled_ids = set()
         
         if not os.path.exists(output_folder):
             return crawled_ids
         
+        # Prefer the lightweight crawled index over parsing every batch file
+        index_path = os.path.join(output_folder, "crawled_ids.ndjson")
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    # A line without its newline was torn by an interrupted write
+                    if not line.endswith('\n'):
+                        continue
+                    product_id = line.split('\t', 1)[0]
+                    try:
+                        crawled_ids.add(int(product_id))
+                    except ValueError:
+                        continue
+        else:
+            for ids in map_batch_files(_read_batch_ids, list_batch_files(output_folder)):
+                crawled_ids.update(int(pid) for pid in ids if pid)
+        
+        # Products streamed by an interrupted batch that hasn't been repacked yet
+        # (load_existing_results normally repacks these before the queue is built)
         for filename in os.listdir(output_folder):
-            if filename.startswith("products_") and filename.endswith(".json"):
+            if filename.startswith("products_") and filename.endswith(".ndjson"):
                 try:
-                    filepath = os.path.join(output_folder, filename)
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        for product in data:
-                            if product.get('id'):
-                                crawled_ids.add(str(product['id']))
+                    for product in iter_ndjson(os.path.join(output_folder, filename)):
+                        if product.get('id'):
+                            crawled_ids.add(int(product['id']))
                 except Exception as e:
                     print(f"Error reading {filename}: {e}")
         
@@ -35,28 +59,22 @@ class DeduplicationUtils:
     @staticmethod
     def check_duplicate_products_in_output(output_folder):
         """Check for duplicate products across all batch files"""
-        product_ids_seen = {}
+        first_seen = {}  # product ID -> first file it appeared in
+        duplicates = {}  # product ID -> every file it appeared in, only on collision
         
         if not os.path.exists(output_folder):
             return
         
-        for filename in os.listdir(output_folder):
-            if filename.startswith("products_") and filename.endswith(".json"):
-                try:
-                    filepath = os.path.join(output_folder, filename)
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        for product in data:
-                            product_id = str(product.get('id', 'unknown'))
-                            if product_id in product_ids_seen:
-                                product_ids_seen[product_id].append(filename)
-                            else:
-                                product_ids_seen[product_id] = [filename]
-                except Exception as e:
-                    print(f"Error checking duplicates in {filename}: {e}")
-        
-        duplicates = {pid: files for pid, files in product_ids_seen.items() 
-                     if len(files) > 1}
+        filepaths = list_batch_files(output_folder)
+        for filepath, ids in zip(filepaths, map_batch_files(_read_batch_ids, filepaths)):
+            filename = os.path.basename(filepath)
+            for pid in ids:
+                product_id = 'unknown' if pid is None else pid
+                prev = first_seen.get(product_id)
+                if prev is None:
+                    first_seen[product_id] = filename
+                else:
+                    duplicates.setdefault(product_id, [prev]).append(filename)
         
         if duplicates:
             print(f"\n⚠️  Found {len(duplicates)} duplicate products:")
@@ -1,7 +1,86 @@
+import asyncio
 import os
-import json
-import aiofiles
+import orjson
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+_MAX_READ_WORKERS = 8
+
+
+def _atomic_write(filename, data):
+    """Write bytes to a temp file and move it into place in one step"""
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
+
+
+def _append_bytes(filename, data):
+    """Append bytes to a file with a single write"""
+    with open(filename, 'ab') as f:
+        f.write(data)
+
+
+def _truncate_to_last_newline(filename, chunk_size=8192):
+    """Drop a trailing partial line left in an NDJSON file by an interrupted write"""
+    with open(filename, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - chunk_size)
+            f.seek(start)
+            newline_at = f.read(pos - start).rfind(b"\n")
+            if newline_at != -1:
+                pos = start + newline_at + 1
+                break
+            pos = start
+        if pos != end:
+            f.truncate(pos)
+
+
+def iter_ndjson(filepath):
+    """Yield decoded NDJSON lines, skipping ones that cannot be decoded"""
+    with open(filepath, 'rb') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                print(f"⚠️  Skipping undecodable line {line_no} in {os.path.basename(filepath)}")
+
+
+def list_batch_files(output_folder):
+    """List paths of finished products_*.json batch files"""
+    return [
+        os.path.join(output_folder, filename)
+        for filename in os.listdir(output_folder)
+        if filename.startswith("products_") and filename.endswith(".json")
+    ]
+
+
+def map_batch_files(func, filepaths):
+    """Apply func to each batch file on a thread pool, yielding results in order"""
+    # Overlap file reads across threads; orjson parsing holds the GIL
+    with ThreadPoolExecutor(max_workers=_MAX_READ_WORKERS) as executor:
+        yield from executor.map(func, filepaths)
+
+
+def _failed_id(product_id):
+    """Normalize a failure record's product ID; older files stored it as a str"""
+    try:
+        return int(product_id)
+    except (TypeError, ValueError):
+        return product_id
+
+
+def _with_iso_timestamp(failed_product):
+    """Return the failure record with an epoch timestamp formatted as ISO 8601"""
+    timestamp = failed_product.get("timestamp")
+    if isinstance(timestamp, (int, float)):
+        return {**failed_product, "timestamp": datetime.fromtimestamp(timestamp).isoformat()}
+    return failed_product
 
 
 class FileHandler:
@@ -9,17 +88,127 @@ class FileHandler:
     
     def __init__(self, output_folder):
         self.output_folder = output_folder
+        self.ids_index_path = os.path.join(output_folder, "crawled_ids.ndjson")
+        self._ids_log = None
+        self._saved_failed_ids = defaultdict(set)
     
-    async def save_batch(self, products, batch_index):
-        """Save batch to JSON file"""
-        filename = f"{self.output_folder}/products_{batch_index+1}.json"
-        async with aiofiles.open(filename, 'w', encoding='utf-8') as f:
-            await f.write(json.dumps(products, ensure_ascii=False, indent=2))
+    def next_batch_number(self):
+        """Return the first batch file number not used by any products_<n> file"""
+        used = [0]
+        for filename in os.listdir(self.output_folder):
+            if filename.startswith("products_") and filename.endswith((".json", ".ndjson")):
+                number = filename[len("products_"):].split(".", 1)[0]
+                if number.isdigit():
+                    used.append(int(number))
+        return max(used) + 1
+    
+    def open_batch_stream(self, batch_num):
+        """Open the NDJSON file that a batch streams its products into"""
+        stream_path = f"{self.output_folder}/products_{batch_num}.ndjson"
+        # Append so products left over from an interrupted run are kept, but
+        # cut off any half-written line so new products start on a fresh one
+        if os.path.exists(stream_path):
+            _truncate_to_last_newline(stream_path)
+        return open(stream_path, 'ab')
+    
+    @staticmethod
+    def append_product(stream, product):
+        """Write a single product as one NDJSON line"""
+        stream.write(orjson.dumps(product) + b"\n")
+    
+    async def save_batch(self, batch_num, has_missing_fields_func):
+        """Repack a streamed batch into its JSON file and record its IDs in the crawled index"""
+        await asyncio.to_thread(
+            self._repack_batch,
+            f"{self.output_folder}/products_{batch_num}.ndjson",
+            f"{self.output_folder}/products_{batch_num}.json",
+            has_missing_fields_func
+        )
+    
+    def repack_partial_batches(self, has_missing_fields_func):
+        """Repack and index NDJSON batches left unfinished by an interrupted run"""
+        for filename in os.listdir(self.output_folder):
+            if filename.startswith("products_") and filename.endswith(".ndjson"):
+                stream_path = os.path.join(self.output_folder, filename)
+                target = os.path.join(self.output_folder, filename[:-len(".ndjson")] + ".json")
+                if os.path.exists(target):
+                    target = f"{self.output_folder}/products_{self.next_batch_number()}.json"
+                print(f"♻️  Recovering interrupted batch {filename} into {os.path.basename(target)}")
+                self._repack_batch(stream_path, target, has_missing_fields_func)
+    
+    def _repack_batch(self, stream_path, filename, has_missing_fields_func):
+        """Copy a batch's NDJSON lines into a JSON array one product at a time"""
+        tmp_filename = f"{filename}.tmp"
+        index_lines = []
+        
+        with open(stream_path, 'rb') as src, open(tmp_filename, 'wb') as dst:
+            dst.write(b"[")
+            separator = b"\n"
+            for line_no, line in enumerate(src, 1):
+                line = line.rstrip(b"\n")
+                if not line:
+                    continue
+                try:
+                    product = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    print(f"⚠️  Skipping undecodable line {line_no} in {os.path.basename(stream_path)}")
+                    continue
+                dst.write(separator + line)
+                separator = b",\n"
+                index_lines.append(self._index_line(product, has_missing_fields_func))
+            dst.write(b"\n]")
+        os.replace(tmp_filename, filename)
+        
+        # Index only after the batch file is on disk so a crash never marks
+        # unsaved products as crawled
+        self._write_index_lines(index_lines)
+        os.remove(stream_path)
+    
+    @staticmethod
+    def _index_line(product, has_missing_fields_func):
+        """Format a product as an "<id>\\t<missing>" crawled index line"""
+        return f"{product.get('id') or ''}\t{int(has_missing_fields_func(product))}\n"
+    
+    def _write_index_lines(self, lines):
+        """Append preformatted lines to the crawled index"""
+        if self._ids_log is None:
+            self._ids_log = open(self.ids_index_path, 'ab')
+        
+        self._ids_log.write("".join(lines).encode('utf-8'))
+        self._ids_log.flush()
+    
+    def close(self):
+        """Close the crawled index file if it is open"""
+        if self._ids_log is not None:
+            self._ids_log.close()
+            self._ids_log = None
+    
+    def rebuild_ids_index(self, has_missing_fields_func):
+        """Rebuild the crawled index from existing batch files"""
+        def index_file(filepath):
+            try:
+                with open(filepath, 'rb') as f:
+                    data = orjson.loads(f.read())
+                return [self._index_line(product, has_missing_fields_func) for product in data]
+            except Exception as e:
+                print(f"Error indexing {os.path.basename(filepath)}: {e}")
+                return []
+        
+        # Build the index under a temp name so an interrupted rebuild never
+        # leaves a partial index that later runs would trust as complete
+        tmp_path = f"{self.ids_index_path}.tmp"
+        with open(tmp_path, 'wb') as out:
+            for lines in map_batch_files(index_file, list_batch_files(self.output_folder)):
+                out.write("".join(lines).encode('utf-8'))
+        os.replace(tmp_path, self.ids_index_path)
     
     async def save_failed_products_by_error(self, failed_products):
         """Save failed products grouped by error code"""
         if not failed_products:
             return
+        
+        # Failures are timestamped with time.time(); format them only here
+        failed_products = [_with_iso_timestamp(p) for p in failed_products]
             
         # Group failed products by error code
         failed_by_error = defaultdict(list)
@@ -27,35 +216,30 @@ class FileHandler:
             error_code = failed_product.get("error_code", "UNKNOWN")
             failed_by_error[error_code].append(failed_product)
         
-        # Save each error type to separate files
+        # Append new failures of each error type to separate NDJSON files
         for error_code, products in failed_by_error.items():
-            filename = f"{self.output_folder}/failed_{error_code.lower()}.json"
+            filename = f"{self.output_folder}/failed_{error_code.lower()}.ndjson"
             
-            # Load existing failed products for this error code
-            existing_failed = []
-            if os.path.exists(filename):
-                try:
-                    with open(filename, 'r', encoding='utf-8') as f:
-                        existing_failed = json.load(f)
-                except Exception as e:
-                    print(f"Error loading existing {filename}: {e}")
+            # Skip products already recorded for this error code
+            saved_ids = self._saved_failed_ids[error_code]
+            new_failed = []
+            for p in products:
+                product_id = _failed_id(p.get("product_id"))
+                if product_id not in saved_ids:
+                    saved_ids.add(product_id)
+                    new_failed.append(p)
             
-            # Combine and deduplicate
-            existing_ids = {item.get("product_id") for item in existing_failed}
-            new_failed = [p for p in products if p.get("product_id") not in existing_ids]
-            all_failed = existing_failed + new_failed
-            
-            # Save to file
-            async with aiofiles.open(filename, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(all_failed, ensure_ascii=False, indent=2))
+            if new_failed:
+                buf = b"".join(orjson.dumps(p) + b"\n" for p in new_failed)
+                await asyncio.to_thread(_append_bytes, filename, buf)
             
             print(f"💾 Saved {len(new_failed)} new {error_code} failures to {filename}")
-            print(f"📊 Total {error_code} failures: {len(all_failed)}")
+            print(f"📊 Total {error_code} failures: {len(saved_ids)}")
         
         # Also save a consolidated failed products list
         all_failed_path = f"{self.output_folder}/all_failed_products.json"
-        async with aiofiles.open(all_failed_path, 'w', encoding='utf-8') as f:
-            await f.write(json.dumps(failed_products, ensure_ascii=False, indent=2))
+        buf = orjson.dumps(failed_products, option=orjson.OPT_INDENT_2)
+        await asyncio.to_thread(_atomic_write, all_failed_path, buf)
         
         print(f"💾 Saved all failed products to {all_failed_path}")
         
@@ -72,31 +256,40 @@ class FileHandler:
         if not os.path.exists(self.output_folder):
             return
             
-        # Load existing successful results
-        for filename in os.listdir(self.output_folder):
-            if filename.startswith("products_") and filename.endswith(".json"):
-                try:
-                    filepath = os.path.join(self.output_folder, filename)
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        for product in data:
-                            stats.add_success()
-                            if has_missing_fields_func(product):
-                                stats.add_missing_fields()
-                except Exception as e:
-                    print(f"Error loading {filename}: {e}")
+        # Load existing successful results from the crawled index
+        if not os.path.exists(self.ids_index_path):
+            self.rebuild_ids_index(has_missing_fields_func)
+        else:
+            # Drop a line torn by an interrupted append before adding to it
+            _truncate_to_last_newline(self.ids_index_path)
+        
+        # Turn batches streamed by an interrupted run into regular, indexed
+        # batch files so they are counted below and seen by duplicate checks
+        self.repack_partial_batches(has_missing_fields_func)
+        
+        with open(self.ids_index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                _, _, missing = line.rstrip('\n').partition('\t')
+                stats.add_success()
+                if missing == '1':
+                    stats.add_missing_fields()
         
         # Load existing failed results from error-specific files
+        # (NDJSON, plus JSON arrays written by older versions)
         for filename in os.listdir(self.output_folder):
-            if filename.startswith("failed_") and filename.endswith(".json"):
+            if filename.startswith("failed_") and filename.endswith((".ndjson", ".json")):
                 try:
                     filepath = os.path.join(self.output_folder, filename)
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        failed_data = json.load(f)
-                        for failed_item in failed_data:
-                            error_code = failed_item.get("error_code", "UNKNOWN")
-                            stats.failed += 1
-                            stats.error_codes[error_code] += 1
-                            stats.failed_products.append(failed_item)
+                    with open(filepath, 'rb') as f:
+                        if filename.endswith(".ndjson"):
+                            failed_data = [orjson.loads(line) for line in f if line.strip()]
+                        else:
+                            failed_data = orjson.loads(f.read())
+                    for failed_item in failed_data:
+                        error_code = failed_item.get("error_code", "UNKNOWN")
+                        stats.failed += 1
+                        stats.error_codes[error_code] += 1
+                        stats.failed_products.append(failed_item)
+                        self._saved_failed_ids[error_code].add(_failed_id(failed_item.get("product_id")))
                 except Exception as e:
                     print(f"Error loading {filename}: {e}")
\ No newline at end of file
@@ -1,109 +1,176 @@
 import asyncio
 import aiohttp
+import contextlib
+import orjson
 import pandas as pd
-import re
 import os
+import random
 import time
-from tqdm.asyncio import tqdm_asyncio
+from aiolimiter import AsyncLimiter
+from selectolax.lexbor import LexborHTMLParser
+from tqdm import tqdm
 
 from src.crawl_stats import CrawlStats
 from src.deduplication import DeduplicationUtils
 from src.file_handler import FileHandler
 
+_BASE_URL = "https://api.tiki.vn"
+_URL_PREFIX = "/product-detail/api/v1/products/"
+_HEADERS = {"User-Agent": "Mozilla/5.0", "Accept": "application/json"}
+
 
 class TikiCrawler:
     """Main crawler class for Tiki products"""
     
+    # Required fields checked for truthiness; 'images' is checked separately
+    _REQ_SIMPLE = ('id', 'name', 'url_key', 'price', 'description')
+    # Client errors that will never succeed on retry (e.g. 404 for deleted products)
+    _NO_RETRY = {400, 401, 403, 404, 410}
+    
     def __init__(self, input_file="product_ids.csv", output_folder="products_json", 
-                 batch_size=1000, concurrent_requests=50, max_retries=5):
+                 batch_size=1000, concurrent_requests=50, max_retries=5,
+                 max_description_len=4096, requests_per_second=50):
         self.input_file = input_file
         self.output_folder = output_folder
         self.batch_size = batch_size
         self.concurrent_requests = concurrent_requests
         self.max_retries = max_retries
+        self.max_description_len = max_description_len  # Cleaned descriptions are truncated to this many chars
+        self.requests_per_second = requests_per_second  # Run-wide request rate cap; None disables it
         self.stats = CrawlStats()
         self.product_ids = []
         self.file_handler = FileHandler(output_folder)
+        self._connector = None
+        self._session = None
+        self._semaphore = None
+        self._limiter = None
+        
+    async def __aenter__(self):
+        """Open a shared HTTP session reused across all batches"""
+        self._connector = aiohttp.TCPConnector(
+            limit=self.concurrent_requests,
+            limit_per_host=self.concurrent_requests,
+            ttl_dns_cache=600,
+            keepalive_timeout=75
+        )
+        self._session = aiohttp.ClientSession(
+            base_url=_BASE_URL,
+            headers=_HEADERS,
+            connector=self._connector,
+            timeout=aiohttp.ClientTimeout(total=20)
+        )
+        self._semaphore = asyncio.Semaphore(self.concurrent_requests)
+        if self.requests_per_second:
+            self._limiter = AsyncLimiter(max_rate=self.requests_per_second, time_period=1)
+        else:
+            self._limiter = contextlib.nullcontext()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        """Close the shared HTTP session and its connection pool"""
+        await self._session.close()
+        self._session = None
+        self._connector = None
+        self._semaphore = None
+        self._limiter = None
         
     def load_product_ids(self):
         """Load product IDs from CSV file"""
-        df = pd.read_csv(self.input_file)
-        self.product_ids = df['id'].astype(str).tolist()
+        df = pd.read_csv(
+            self.input_file,
+            usecols=['id'],
+            dtype={'id': 'int64'},
+            engine='pyarrow'
+        )
+        # Keep IDs as ints in memory; they are only formatted when building URLs
+        self.product_ids = df['id'].tolist()
         self.stats.total_products = len(self.product_ids)
         print(f"Loaded {len(self.product_ids)} product IDs")
         
-    def deduplicate_input_ids(self):
-        """Remove duplicate product IDs from input list"""
+    def _prepare_queue(self):
+        """Deduplicate input IDs and drop already crawled products in one pass"""
+        already_crawled = DeduplicationUtils.get_already_crawled_ids(self.output_folder)
         original_count = len(self.product_ids)
-        self.product_ids = DeduplicationUtils.deduplicate_list(self.product_ids)
-        duplicate_count = original_count - len(self.product_ids)
         
+        seen = set()
+        queue = []
+        seen_add = seen.add
+        append = queue.append
+        skipped_count = 0
+        
+        for pid in self.product_ids:
+            if pid in seen:
+                continue
+            seen_add(pid)
+            if pid in already_crawled:
+                skipped_count += 1
+            else:
+                append(pid)
+        
+        duplicate_count = original_count - len(seen)
         if duplicate_count > 0:
             print(f"🔄 Removed {duplicate_count} duplicate product IDs")
-            print(f"📊 Unique products to crawl: {len(self.product_ids)}")
+            print(f"📊 Unique products to crawl: {len(seen)}")
         
-        self.stats.total_products = len(self.product_ids)
-
-    def filter_uncrawled_products(self):
-        """Remove already crawled products from the queue"""
-        already_crawled = DeduplicationUtils.get_already_crawled_ids(self.output_folder)
+        if skipped_count > 0:
+            print(f"⏭️  Skipping {skipped_count} already crawled products")
+            print(f"🎯 Remaining products to crawl: {len(queue)}")
         
-        if already_crawled:
-            original_count = len(self.product_ids)
-            self.product_ids = [pid for pid in self.product_ids if pid not in already_crawled]
-            skipped_count = original_count - len(self.product_ids)
-            
-            if skipped_count > 0:
-                print(f"⏭️  Skipping {skipped_count} already crawled products")
-                print(f"🎯 Remaining products to crawl: {len(self.product_ids)}")
+        self.stats.total_products = len(seen)
+        self.product_ids = queue
         
     def clean_description(self, text):
         """Clean HTML tags and normalize whitespace in description"""
         if not text:
             return ""
-        text = re.sub(r"<[^>]+>", "", text)
-        text = re.sub(r"\s+", " ", text)
-        return text.strip()
+        # str.split() with no arguments collapses and trims whitespace
+        return " ".join(LexborHTMLParser(text).text().split())
 
     def has_missing_fields(self, product_data):
         """Check if product has missing required fields"""
-        required_fields = ['id', 'name', 'url_key', 'price', 'description', 'images']
-        for field in required_fields:
-            if field == 'images':
-                if not isinstance(product_data.get(field), list) or len(product_data[field]) == 0:
-                    return True
-            elif not product_data.get(field):
-                return True
-        return False
+        imgs = product_data.get('images')
+        if not (isinstance(imgs, list) and imgs):
+            return True
+        get = product_data.get
+        return not all(get(f) for f in self._REQ_SIMPLE)
 
     async def fetch_product(self, session, product_id):
         """Fetch single product with retry logic"""
-        url = f"https://api.tiki.vn/product-detail/api/v1/products/{product_id}"
+        url = _URL_PREFIX + str(product_id)
         last_error = None
         
         for attempt in range(self.max_retries):
             try:
-                async with session.get(url, timeout=20) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        product_data = {
-                            "id": data.get("id"),
-                            "name": data.get("name"),
-                            "url_key": data.get("url_key"),
-                            "price": data.get("price"),
-                            "description": self.clean_description(data.get("description")),
-                            "images": [img.get("base_url") for img in data.get("images", [])]
-                        }
+                # Take a concurrency slot before a rate token so queued tasks
+                # don't use up tokens and then fire in a burst
+                async with self._semaphore, self._limiter:
+                    async with session.get(url) as resp:
+                        if resp.status == 200:
+                            # orjson holds the GIL, so this doesn't parallelise parsing; it
+                            # only keeps a large decode from running inline in this coroutine,
+                            # letting the loop service other sockets between thread switches
+                            raw = await resp.read()
+                            data = await asyncio.to_thread(orjson.loads, raw)
+                            product_data = {
+                                "id": data.get("id"),
+                                "name": data.get("name"),
+                                "url_key": data.get("url_key"),
+                                "price": data.get("price"),
+                                "description": self.clean_description(data.get("description"))[:self.max_description_len],
+                                "images": [img.get("base_url") for img in data.get("images", [])]
+                            }
                         
-                        if self.has_missing_fields(product_data):
-                            self.stats.add_missing_fields()
+                            if self.has_missing_fields(product_data):
+                                self.stats.add_missing_fields()
                         
-                        self.stats.add_success()
-                        return product_data
-                    else:
-                        last_error = f"HTTP {resp.status}"
-                        if attempt == 0 and resp.status != 404:
-                            print(f"Failed {product_id}: HTTP {resp.status}")
+                            self.stats.add_success()
+                            return product_data
+                        else:
+                            last_error = f"HTTP {resp.status}"
+                            if attempt == 0 and resp.status != 404:
+                                print(f"Failed {product_id}: HTTP {resp.status}")
+                            if resp.status in self._NO_RETRY:
+                                break
                         
             except asyncio.TimeoutError:
                 last_error = "Request timeout"
@@ -115,7 +182,8 @@ class TikiCrawler:
                     print(f"Error {product_id}: {str(e)[:50]}")
             
             if attempt < self.max_retries - 1:
-                await asyncio.sleep(1 * (attempt + 1))
+                # Exponential backoff with jitter to avoid synchronized retries
+                await asyncio.sleep(min(30, 0.5 * 2 ** attempt) + random.random() * 0.5)
         
         # All attempts failed, record the failure
         error_code = "TIMEOUT" if "timeout" in str(last_error).lower() else "ERROR"
@@ -125,25 +193,50 @@ class TikiCrawler:
         self.stats.add_failure(error_code, product_id, last_error)
         return None
 
-    async def fetch_batch(self, product_ids, batch_num, total_batches):
+    async def fetch_batch(self, session, product_ids, batch_num, total_batches, file_num):
         """Fetch a batch of products with progress tracking"""
-        connector = aiohttp.TCPConnector(limit=self.concurrent_requests)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            results = []
-            print(f"\nProcessing batch {batch_num}/{total_batches} ({len(product_ids)} products)")
-            
-            for i in range(0, len(product_ids), self.concurrent_requests):
-                chunk_ids = product_ids[i:i+self.concurrent_requests]
-                tasks = [self.fetch_product(session, pid) for pid in chunk_ids]
-                
-                chunk_results = await tqdm_asyncio.gather(
-                    *tasks, desc=f"Batch {batch_num} - Chunk {i//self.concurrent_requests + 1}"
-                )
-                
-                results.extend([r for r in chunk_results if r is not None])
-                print(f"Batch {batch_num} progress: {min(i + self.concurrent_requests, len(product_ids))}/{len(product_ids)}")
+        print(f"\nProcessing batch {batch_num}/{total_batches} ({len(product_ids)} products)")
+        
+        # Concurrency is bounded by the semaphore in fetch_product, so a slow
+        # retry only holds up its own task instead of a whole chunk
+        pbar = tqdm(total=len(product_ids), desc=f"Batch {batch_num}")
+        with self.file_handler.open_batch_stream(file_num) as stream:
+            tasks = [
+                asyncio.create_task(self._fetch_and_stream(session, pid, stream))
+                for pid in product_ids
+            ]
+            for task in tasks:
+                task.add_done_callback(lambda _: pbar.update())
             
-            return results
+            try:
+                batch_results = await asyncio.gather(*tasks)
+            finally:
+                pbar.close()
+        
+        return sum(batch_results)
+
+    async def _fetch_and_stream(self, session, product_id, stream):
+        """Fetch a product and write it straight to the batch stream"""
+        product = await self.fetch_product(session, product_id)
+        if product is None:
+            return False
+        self.file_handler.append_product(stream, product)
+        return True
+
+    async def _finish_batch(self, batch_task, batch_num, file_num, batch_len, batch_start):
+        """Wait for a scheduled batch, save it and print its summary"""
+        fetched_count = await batch_task
+        batch_duration = time.time() - batch_start
+        
+        await self.file_handler.save_batch(file_num, self.has_missing_fields)
+        
+        # Batch summary
+        print(f"✅ Batch {batch_num} completed: {fetched_count}/{batch_len} products saved")
+        print(f"⏱️  Batch time: {batch_duration:.2f}s, Rate: {fetched_count/batch_duration:.2f} products/sec")
+        print(f"📊 Overall progress: {self.stats.completed}/{len(self.product_ids)} ({self.stats.completed/len(self.product_ids)*100:.1f}%)")
+        
+        if self.stats.failed > 0:
+            print(f"❌ Failures so far: {self.stats.failed}")
 
     async def crawl(self):
         """Main crawling method with deduplication"""
@@ -151,9 +244,8 @@ class TikiCrawler:
         os.makedirs(self.output_folder, exist_ok=True)
         
         # Add deduplication steps
-        self.deduplicate_input_ids()
         self.file_handler.load_existing_results(self.stats, self.has_missing_fields)
-        self.filter_uncrawled_products()
+        self._prepare_queue()
         
         # If no products left to crawl
         if not self.product_ids:
@@ -167,36 +259,42 @@ class TikiCrawler:
         print(f"Batch size: {self.batch_size}, Concurrent requests: {self.concurrent_requests}")
         print("-" * 50)
         
-        for start in range(0, len(self.product_ids), self.batch_size):
-            end = min(start + self.batch_size, len(self.product_ids))
-            batch_ids = self.product_ids[start:end]
-            batch_index = start // self.batch_size
-            batch_num = batch_index + 1
-            filename = f"{self.output_folder}/products_{batch_num}.json"
-            
-            # Skip existing batches
-            if os.path.exists(filename):
-                print(f"Batch {batch_num}/{total_batches} already exists, skipping...")
-                continue
+        async with self:
+            # Keep the next batch's requests in flight while the previous one
+            # finishes; batches only shard results on disk, pacing is done by
+            # the rate limiter in fetch_product
+            pending = None
+            # The queue only holds uncrawled IDs, so new batches always go to
+            # fresh files after any left by earlier runs
+            first_file_num = self.file_handler.next_batch_number()
+            try:
+                for start in range(0, len(self.product_ids), self.batch_size):
+                    end = min(start + self.batch_size, len(self.product_ids))
+                    batch_ids = self.product_ids[start:end]
+                    batch_index = start // self.batch_size
+                    batch_num = batch_index + 1
+                    file_num = first_file_num + batch_index
 
-            print(f"\n{'='*20} BATCH {batch_num}/{total_batches} {'='*20}")
-            print(f"Products {start+1} to {end}")
-            
-            batch_start = time.time()
-            products = await self.fetch_batch(batch_ids, batch_num, total_batches)
-            batch_duration = time.time() - batch_start
-            
-            await self.file_handler.save_batch(products, batch_index)
-            
-            # Batch summary
-            print(f"✅ Batch {batch_num} completed: {len(products)}/{len(batch_ids)} products saved")
-            print(f"⏱️  Batch time: {batch_duration:.2f}s, Rate: {len(products)/batch_duration:.2f} products/sec")
-            print(f"📊 Overall progress: {self.stats.completed}/{len(self.product_ids)} ({self.stats.completed/len(self.product_ids)*100:.1f}%)")
+                    print(f"\n{'='*20} BATCH {batch_num}/{total_batches} {'='*20}")
+                    print(f"Products {start+1} to {end} -> products_{file_num}.json")
             
-            if self.stats.failed > 0:
-                print(f"❌ Failures so far: {self.stats.failed}")
+                    batch_start = time.time()
+                    batch_task = asyncio.create_task(
+                        self.fetch_batch(self._session, batch_ids, batch_num, total_batches, file_num)
+                    )
+                    previous, pending = pending, (batch_task, batch_num, file_num, len(batch_ids), batch_start)
+                    if previous:
+                        await self._finish_batch(*previous)
             
-            await asyncio.sleep(2)  # Respectful delay
+                if pending:
+                    last, pending = pending, None
+                    await self._finish_batch(*last)
+            finally:
+                # Don't leave a scheduled batch running once the session closes
+                if pending and not pending[0].done():
+                    pending[0].cancel()
+                    await asyncio.gather(pending[0], return_exceptions=True)
+                self.file_handler.close()
         
         self.stats.end_time = time.time()
         await self.file_handler.save_failed_products_by_error(self.stats.failed_products)